@@ -4,16 +4,51 @@ Whisper文字起こしWebアプリ（Streamlit使用）
 """
 
 import os
+
+# 推論のスレッド数（Streamlit用に1コア残す）。torchのimportより前に設定する必要がある
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) - 1)))
+
 import sys
 import time
-import tempfile
-import whisper
+import numpy as np
 import torch
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 import streamlit as st
-from datetime import datetime
+from timestamp_utils import format_segment
 import subprocess
 import zipfile
 import io
+import asyncio
+import contextvars
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# GPUで同時に文字起こしするファイル数の上限（モデルのワーカー数と揃える）
+TRANSCRIBE_WORKERS = min(4, os.cpu_count() or 1)
+
+# 文字起こし待ちの状態で先読みデコードしておくファイル数の上限
+AUDIO_PREFETCH = 2
+
+# 文字起こし中のプレビューを再描画する最短間隔（秒）
+PREVIEW_INTERVAL = 0.5
+
+# Whisperの入力サンプリングレート
+SAMPLE_RATE = 16000
+
+# 1回のエンコーダ呼び出しで扱える音声の長さ（これ以下の短い音声はGPUでまとめて処理する）
+SHORT_CLIP_SAMPLES = 30 * SAMPLE_RATE
+
+# タイムスタンプトークン1つあたりの秒数
+TIME_PRECISION = 0.02
+
+# 短い音声をまとめて処理する際の無音・デコード失敗の判定しきい値（faster-whisperの既定値と同じ）
+NO_SPEECH_THRESHOLD = 0.6
+LOG_PROB_THRESHOLD = -1.0
+COMPRESSION_RATIO_THRESHOLD = 2.4
 
 # ページ設定
 st.set_page_config(
@@ -22,12 +57,337 @@ st.set_page_config(
     layout="wide"
 )
 
+def get_model_workers(device):
+    """モデルのワーカー数（同時に文字起こしするファイル数）を返す"""
+    # CPUではスレッドを分け合うと1ファイルあたりが遅くなるため、1ファイルずつ全スレッドで処理する
+    return TRANSCRIBE_WORKERS if device == "cuda" else 1
+
 # キャッシュ設定（モデルを再ロードしないようにする）
 @st.cache_resource
-def load_whisper_model(model_name):
-    """Whisperモデルをロードする（キャッシュ使用）"""
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    return whisper.load_model(model_name, device=device)
+def load_whisper_model(model_name, device, compute_type):
+    """Whisperモデルをロードする（キャッシュ使用）
+
+    faster-whisper（CTranslate2）を使用する。デバイスと演算精度もキャッシュのキーに含まれる
+    GPUでは複数スレッドからの同時呼び出しを並列に処理できるよう、ワーカー数を指定する
+    CPUではcpu_threadsがワーカーごとに確保されるため、1ワーカーにOMP_NUM_THREADSのスレッドをすべて割り当てる
+    """
+    cpu_threads = int(os.environ["OMP_NUM_THREADS"]) if device == "cpu" else 0
+    model = WhisperModel(model_name, device=device, compute_type=compute_type,
+                         cpu_threads=cpu_threads, num_workers=get_model_workers(device))
+    
+    # 1秒の無音で一度推論し、初回呼び出しの初期化コストをロード時に済ませておく
+    try:
+        segments, info = model.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), beam_size=1)
+        list(segments)
+    except Exception:
+        pass
+    
+    return model
+
+def decode_upload(uploaded_file):
+    """アップロードされた音声を一時ファイルを介さず、メモリ上で16kHzモノラルのfloat32配列にデコードする"""
+    # UploadedFileはファイルライクなので、内容をコピーせずにそのまま読ませる
+    uploaded_file.seek(0)
+    return decode_audio(uploaded_file, sampling_rate=SAMPLE_RATE)
+
+def hash_upload(uploaded_file):
+    """アップロードされた音声ファイルの内容のハッシュ値を返す（キャッシュのキーに使用）"""
+    # getvalue()は読み込み位置を動かさないため、デコードスレッドの読み込みと干渉しない
+    return hashlib.blake2b(uploaded_file.getvalue()).hexdigest()
+
+class NotCachedError(Exception):
+    """文字起こし結果がキャッシュにないことを示す"""
+
+@st.cache_data(show_spinner=False)
+def transcribe_audio_cached(audio_hash, model_name, device, compute_type, options, _transcribe):
+    """
+    文字起こし結果をキャッシュする（音声の内容ハッシュとモデル設定をキーにする）
+    
+    同じファイルを再アップロードした場合は再デコードせずに前回の結果を返す
+    キャッシュにない場合のみ_transcribe()を呼んで結果を求める
+    アンダースコアで始まる引数はキャッシュのキーに含まれない
+    
+    Parameters:
+        audio_hash (str): 音声ファイルの内容のハッシュ値
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス
+        compute_type (str): 演算精度
+        options (dict): 文字起こしオプション
+        _transcribe (callable): 文字起こし結果（text, segments）を返す関数
+        
+    Returns:
+        dict: 文字起こし結果（text, segments）
+    """
+    return _transcribe()
+
+def lookup_cached_result(audio_hash, model_name, device, compute_type, options):
+    """
+    キャッシュ済みの文字起こし結果を返す（キャッシュにない場合はNone）
+    
+    例外を送出した呼び出しはキャッシュされないため、何も保存せずに有無だけを確認できる
+    """
+    def not_cached():
+        raise NotCachedError()
+    
+    try:
+        return transcribe_audio_cached(audio_hash, model_name, device, compute_type, options, not_cached)
+    except NotCachedError:
+        return None
+
+def transcribe_audio(audio, model_name, device, compute_type, options, on_segment=None):
+    """
+    デコード済みの音声を文字起こしする
+    
+    Parameters:
+        audio (numpy.ndarray): 16kHzモノラルの音声配列
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス
+        compute_type (str): 演算精度
+        options (dict): pipeline.transcribeに渡すオプション
+        on_segment (callable): セグメントが生成されるたびに呼ばれるコールバック
+        
+    Returns:
+        dict: 文字起こし結果（text, segments）
+    """
+    model = load_whisper_model(model_name, device, compute_type)
+    
+    # 無音区間で30秒以内に区切ったチャンクをまとめてデコードする
+    pipeline = BatchedInferencePipeline(model=model)
+    
+    # 文字起こし実行（segmentsはジェネレータなので、生成されるたびに通知しながら確定させる）
+    segments, info = pipeline.transcribe(audio, **options)
+    collected_segments = []
+    for segment in segments:
+        segment = {"start": segment.start, "end": segment.end, "text": segment.text}
+        collected_segments.append(segment)
+        if on_segment:
+            on_segment(segment)
+    
+    return {
+        "text": "".join(segment["text"] for segment in collected_segments),
+        "segments": collected_segments
+    }
+
+def transcribe_file(uploaded_file, audio_hash, audio, model_name, device, compute_type, options, on_segment=None):
+    """
+    アップロードされた1ファイルを文字起こしする（ワーカースレッドから呼ばれる）
+    
+    Streamlitの描画は行わず、エラーは呼び出し元に送出する
+    
+    Parameters:
+        uploaded_file (UploadedFile): アップロードされた音声ファイル
+        audio_hash (str): 音声ファイルの内容のハッシュ値
+        audio (Future): decode_uploadによるデコード結果のFuture（キャッシュにない場合のみ結果を待つ）
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス
+        compute_type (str): 演算精度
+        options (dict): pipeline.transcribeに渡すオプション
+        on_segment (callable): セグメントが生成されるたびに呼ばれるコールバック
+        
+    Returns:
+        tuple: (文字起こし結果のdict, タイムスタンプ付きテキスト)
+    """
+    file_name = uploaded_file.name
+    
+    # 文字起こし処理
+    transcribe_start = time.time()
+    
+    result = transcribe_audio_cached(
+        audio_hash, model_name, device, compute_type, options,
+        lambda: transcribe_audio(audio.result(), model_name, device, compute_type, options, on_segment)
+    )
+    
+    transcribe_time = time.time() - transcribe_start
+    
+    return build_file_result(file_name, result, transcribe_time)
+
+def build_file_result(file_name, result, transcribe_time):
+    """
+    文字起こし結果を表示用の結果とタイムスタンプ付きテキストにまとめる
+    
+    Parameters:
+        file_name (str): ファイル名
+        result (dict): 文字起こし結果（text, segments）
+        transcribe_time (float): 処理時間（秒）
+        
+    Returns:
+        tuple: (文字起こし結果のdict, タイムスタンプ付きテキスト)
+    """
+    # 結果を保存
+    file_result = {
+        "filename": file_name,
+        "text": result["text"],
+        "transcribe_time": transcribe_time,
+        "segments": result["segments"]
+    }
+    
+    # タイムスタンプ付きテキストも保存
+    timestamp_text = "".join(format_segment(segment) for segment in result["segments"])
+    
+    return file_result, timestamp_text
+
+def split_timestamped_tokens(tokenizer, tokens, duration):
+    """
+    タイムスタンプトークンを含むトークン列をセグメントに分割する
+    
+    Parameters:
+        tokenizer (Tokenizer): デコードに使用したトークナイザ
+        tokens (list): 生成されたトークンID
+        duration (float): 音声の長さ（秒）
+        
+    Returns:
+        list: セグメント（start, end, text）のリスト
+    """
+    segments = []
+    start = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            timestamp = (token - tokenizer.timestamp_begin) * TIME_PRECISION
+            if text_tokens:
+                segments.append({
+                    "start": start,
+                    "end": min(timestamp, duration),
+                    "text": tokenizer.decode(text_tokens)
+                })
+                text_tokens = []
+            start = timestamp
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    
+    # 終了タイムスタンプが出力されなかった末尾のテキスト
+    if text_tokens:
+        segments.append({"start": start, "end": duration, "text": tokenizer.decode(text_tokens)})
+    
+    return segments
+
+def get_compression_ratio(text):
+    """テキストの圧縮率を返す（同じ語句の繰り返しなど、デコードの失敗の検出に使用）"""
+    text_bytes = text.encode("utf-8")
+    return len(text_bytes) / len(zlib.compress(text_bytes))
+
+def transcribe_clips(audios, model_name, device, compute_type, options):
+    """
+    30秒以下の短い音声をまとめて1回のエンコーダ呼び出しで文字起こしする
+    
+    各音声を30秒分のメルスペクトログラムにパディングしてバッチにし、
+    エンコード・言語検出・デコードをすべてバッチ単位で行う
+    通常の文字起こしと結果を揃えるため、VADで音声区間がないものは空の結果とし、
+    無音判定・デコード失敗の判定はfaster-whisperと同じしきい値で行う
+    デコードに失敗したものは、WhisperModel.transcribeで温度を上げながらデコードし直す
+    
+    Parameters:
+        audios (list): デコード済みの音声配列
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス
+        compute_type (str): 演算精度
+        options (dict): 文字起こしオプション
+        
+    Returns:
+        list: 音声ごとの文字起こし結果（text, segments）
+    """
+    model = load_whisper_model(model_name, device, compute_type)
+    empty_result = {"text": "", "segments": []}
+    results = [empty_result] * len(audios)
+    
+    # VADで音声区間が見つからない音声はデコードしない
+    vad_options = VadOptions(**options["vad_parameters"])
+    speech_indices = [
+        i for i, audio in enumerate(audios)
+        if get_speech_timestamps(audio, vad_options)
+    ]
+    if not speech_indices:
+        return results
+    speech_audios = [audios[i] for i in speech_indices]
+    
+    features = np.stack([pad_or_trim(model.feature_extractor(audio)) for audio in speech_audios])
+    encoder_output = model.encode(features)
+    
+    # 言語の指定がなければ、クリップごとに検出する
+    if options["language"]:
+        languages = [options["language"]] * len(speech_audios)
+    elif model.model.is_multilingual:
+        languages = [candidates[0][0][2:-2] for candidates in model.model.detect_language(encoder_output)]
+    else:
+        languages = ["en"] * len(speech_audios)
+    
+    tokenizers = [
+        Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language)
+        for language in languages
+    ]
+    generated = model.model.generate(
+        encoder_output,
+        [tokenizer.sot_sequence for tokenizer in tokenizers],
+        beam_size=options["beam_size"],
+        suppress_blank=True,
+        return_scores=True,
+        return_no_speech_prob=True
+    )
+    
+    # やり直し用のオプション（batch_sizeはBatchedInferencePipeline専用）
+    sequential_options = {key: value for key, value in options.items() if key != "batch_size"}
+    
+    for i, audio, tokenizer, generation in zip(speech_indices, speech_audios, tokenizers, generated):
+        tokens = generation.sequences_ids[0]
+        avg_logprob = generation.scores[0] * len(tokens) / (len(tokens) + 1)
+        
+        # 無音と判定されたものは空の結果とする
+        if generation.no_speech_prob > NO_SPEECH_THRESHOLD and avg_logprob < LOG_PROB_THRESHOLD:
+            continue
+        
+        segments = split_timestamped_tokens(tokenizer, tokens, len(audio) / SAMPLE_RATE)
+        text = "".join(segment["text"] for segment in segments)
+        
+        # デコードに失敗したもの（繰り返しや低い確信度）は、温度を上げながらデコードし直す
+        # BatchedInferencePipelineは最初の温度でしかデコードしないため、逐次処理のtranscribeを使う
+        if get_compression_ratio(text) > COMPRESSION_RATIO_THRESHOLD or avg_logprob < LOG_PROB_THRESHOLD:
+            retry_segments, info = model.transcribe(audio, **sequential_options)
+            segments = [
+                {"start": segment.start, "end": segment.end, "text": segment.text}
+                for segment in retry_segments
+            ]
+            results[i] = {"text": "".join(segment["text"] for segment in segments), "segments": segments}
+            continue
+        
+        results[i] = {"text": text, "segments": segments}
+    
+    return results
+
+def transcribe_short_files(uploaded_files, audio_hashes, audios, model_name, device, compute_type, options,
+                           on_segments):
+    """
+    短い音声ファイルをまとめて文字起こしする（ワーカースレッドから呼ばれる）
+    
+    Parameters:
+        uploaded_files (list): アップロードされた音声ファイル
+        audio_hashes (list): 各音声ファイルの内容のハッシュ値
+        audios (list): デコード済みの音声配列（30秒以下）
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス
+        compute_type (str): 演算精度
+        options (dict): 文字起こしオプション
+        on_segments (list): ファイルごとの、セグメントを通知するコールバック
+        
+    Returns:
+        list: ファイルごとの (文字起こし結果のdict, タイムスタンプ付きテキスト)
+    """
+    transcribe_start = time.time()
+    
+    results = transcribe_clips(audios, model_name, device, compute_type, options)
+    
+    # バッチ全体の処理時間を各ファイルの処理時間とする
+    transcribe_time = time.time() - transcribe_start
+    
+    file_results = []
+    for uploaded_file, audio_hash, result, on_segment in zip(uploaded_files, audio_hashes, results, on_segments):
+        # 通常の文字起こしと同じキーでキャッシュに保存し、再アップロード時はデコードせずに返す
+        transcribe_audio_cached(audio_hash, model_name, device, compute_type, options, lambda result=result: result)
+        
+        for segment in result["segments"]:
+            on_segment(segment)
+        file_results.append(build_file_result(uploaded_file.name, result, transcribe_time))
+    
+    return file_results
 
 def check_ffmpeg():
     """FFmpegがインストールされているか確認"""
@@ -72,11 +432,17 @@ def get_available_models():
     """利用可能なWhisperモデルの一覧を返す"""
     return ["tiny", "base", "small", "medium", "large"]
 
+def get_available_compute_types(device):
+    """デバイスごとに利用可能な演算精度の一覧を返す（先頭が推奨値）"""
+    if device == "cuda":
+        return ["float16", "int8_float16", "float32"]
+    return ["int8", "float32"]
+
 def main():
     """メイン関数"""
     st.title("🎤 Whisper文字起こしツール")
     st.markdown("""
-    OpenAIのWhisperモデルを使用して、音声ファイルからテキストへの文字起こしを行います。
+    OpenAIのWhisperモデル（faster-whisper）を使用して、音声ファイルからテキストへの文字起こしを行います。
     """)
     
     # FFmpegの確認（エラーで停止しない）
@@ -107,12 +473,20 @@ def main():
     )
     
     # デバイス情報表示
-    device = "GPU (CUDA)" if torch.cuda.is_available() else "CPU"
-    st.sidebar.info(f"使用デバイス: {device}")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    st.sidebar.info(f"使用デバイス: {'GPU (CUDA)' if device == 'cuda' else 'CPU'}")
     
-    if device == "CPU":
+    if device == "cpu":
         st.sidebar.warning("GPUが検出されませんでした。処理が遅くなる可能性があります。")
     
+    # 演算精度選択
+    compute_type = st.sidebar.selectbox(
+        "演算精度を選択",
+        options=get_available_compute_types(device),
+        index=0,
+        help="int8/float16は高速でメモリ使用量も少なく、float32は最も正確ですが低速です。"
+    )
+    
     # サイドバーにGitHubリンク
     st.sidebar.markdown("---")
     st.sidebar.markdown("[GitHubリポジトリ](https://github.com/fumifumi0831/whisper-transcription)")
@@ -135,7 +509,7 @@ def main():
             # モデルロード（一度だけ）
             with st.spinner("モデルをロード中..."):
                 model_load_start = time.time()
-                model = load_whisper_model(model_option)
+                load_whisper_model(model_option, device, compute_type)
                 model_load_time = time.time() - model_load_start
                 st.success(f"モデルロード完了（{model_load_time:.2f}秒）")
             
@@ -143,120 +517,276 @@ def main():
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            # 結果を保存するリスト
+            # 結果を保存するリスト（タイムスタンプ付きテキストはファイル名で引けるようにする）
             all_results = []
-            all_timestamps = []
+            all_timestamps = {}
+            
+            # 文字起こしオプション（Silero VADで0.16秒以上の無音区間はデコードしない）
+            # バッチ推論では音声区間を30秒以内のチャンクにまとめ直すため、
+            # 短い無音でも区切った方がデコード対象の無音が減る（BatchedInferencePipelineの既定値と同じ）
+            options = {
+                "language": language_option or None,
+                "vad_filter": True,
+                "vad_parameters": {"min_silence_duration_ms": 160},
+                "beam_size": 1,
+                # GPUではチャンクをまとめてエンコードし、CPUでは並列ワーカーに任せる
+                "batch_size": 8 if device == "cuda" else 1,
+                # セグメント単位のタイムスタンプを得るため、タイムスタンプトークンも生成する
+                "without_timestamps": False
+            }
+            
+            # 文字起こし中のプレビュー（セグメントが生成されるたびに、一定間隔で更新）
+            preview_area = st.empty()
+            previews = []
+            with preview_area.container():
+                for uploaded_file in uploaded_files:
+                    with st.expander(f"⏳ {uploaded_file.name}", expanded=True):
+                        previews.append({
+                            "text": st.empty(),
+                            "timestamps": st.empty(),
+                            "text_parts": [],
+                            "timestamp_lines": [],
+                            "rendered_at": 0.0,
+                            "flush_handle": None
+                        })
+            
+            def flush_preview(idx):
+                """溜まったセグメントでプレビューを再描画する"""
+                preview = previews[idx]
+                preview["text"].text("".join(preview["text_parts"]))
+                preview["timestamps"].text("".join(preview["timestamp_lines"]))
+                preview["rendered_at"] = time.monotonic()
+                if preview["flush_handle"]:
+                    preview["flush_handle"].cancel()
+                    preview["flush_handle"] = None
+            
+            def render_segment(idx, segment):
+                """プレビューにセグメントを追記する（イベントループのスレッドで実行される）"""
+                preview = previews[idx]
+                preview["text_parts"].append(segment["text"])
+                preview["timestamp_lines"].append(format_segment(segment))
+                # セグメントごとに全文を連結し直すと二乗オーダーになるため、再描画は間引く
+                elapsed = time.monotonic() - preview["rendered_at"]
+                if elapsed >= PREVIEW_INTERVAL:
+                    flush_preview(idx)
+                elif preview["flush_handle"] is None:
+                    # セグメントはバッチ単位でまとめて届くため、間引いた分も間隔が空いた時点で描画する
+                    preview["flush_handle"] = asyncio.get_running_loop().call_later(
+                        PREVIEW_INTERVAL - elapsed, flush_preview, idx
+                    )
             
-            # 各ファイルを処理
-            for idx, uploaded_file in enumerate(uploaded_files):
-                file_name = uploaded_file.name
-                file_size_mb = uploaded_file.size / (1024 * 1024)
+            done_count = 0
+            
+            def on_file_done(idx):
+                """ファイルの処理が終わるたびに進捗を更新する"""
+                nonlocal done_count
+                done_count += 1
+                flush_preview(idx)
+                status_text.text(f"処理完了: {uploaded_files[idx].name} ({done_count}/{len(uploaded_files)})")
+                progress_bar.progress(done_count / len(uploaded_files))
+            
+            # GPUでは30秒以下の短いファイルが2件以上あれば、まとめて1回のエンコーダ呼び出しで処理する
+            batch_short_clips = device == "cuda" and len(uploaded_files) > 1
+            short_clips = {}
+            
+            async def transcribe_all():
+                """全ファイルをスレッドで並列に文字起こしし、アップロード順に結果を返す"""
+                loop = asyncio.get_running_loop()
+                max_workers = min(len(uploaded_files), get_model_workers(device))
+                slots = asyncio.Semaphore(max_workers)
+                # 文字起こし中のファイルに加え、AUDIO_PREFETCH件まで先にデコードしておく
+                prefetch_slots = asyncio.Semaphore(max_workers + AUDIO_PREFETCH)
                 
-                status_text.text(f"処理中: {file_name} ({idx + 1}/{len(uploaded_files)})")
-                progress_bar.progress((idx + 1) / len(uploaded_files))
+                # 全ファイルのキャッシュ確認・デコードが終わり、短いファイルが出揃った時点でセットする
+                sorted_count = 0
+                all_sorted = asyncio.Event()
                 
-                # 一時ファイルとして保存
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_name.split('.')[-1]}") as tmp_file:
-                    tmp_file.write(uploaded_file.getvalue())
-                    temp_filename = tmp_file.name
+                def mark_sorted():
+                    nonlocal sorted_count
+                    sorted_count += 1
+                    if sorted_count == len(uploaded_files):
+                        all_sorted.set()
                 
-                try:
-                    # 文字起こし処理
-                    transcribe_start = time.time()
-                    
-                    # 言語オプション設定
-                    options = {}
-                    if language_option:
-                        options["language"] = language_option
-                    
-                    # 文字起こし実行
-                    result = model.transcribe(temp_filename, **options)
-                    
-                    transcribe_time = time.time() - transcribe_start
-                    
-                    # 結果を保存
-                    file_result = {
-                        "filename": file_name,
-                        "text": result["text"],
-                        "transcribe_time": transcribe_time,
-                        "segments": result["segments"]
-                    }
-                    all_results.append(file_result)
-                    
-                    # タイムスタンプ付きテキストも保存
-                    timestamp_text = ""
-                    for segment in result["segments"]:
-                        start_time = segment["start"]
-                        end_time = segment["end"]
-                        text = segment["text"]
+                def is_batched(idx):
+                    # 短いファイルが1件だけならまとめる利点がないため、通常の文字起こしで処理する
+                    return idx in short_clips and len(short_clips) > 1
+                
+                def segment_callback(idx):
+                    # ワーカースレッドからはStreamlitを操作できないため、描画はイベントループに戻して行う
+                    # call_soon_threadsafeは既定で呼び出し元（キャッシュ関数を実行中のワーカー）のコンテキストを
+                    # 引き継ぎ、描画がキャッシュに記録されてしまうため、ループ側のコンテキストで実行する
+                    ctx = contextvars.copy_context()
+                    return lambda segment: loop.call_soon_threadsafe(render_segment, idx, segment, context=ctx)
+                
+                async def transcribe_one(decoder, idx, uploaded_file):
+                    is_sorted = False
+                    try:
+                        async with prefetch_slots:
+                            audio = None
+                            try:
+                                lookup_start = time.time()
+                                audio_hash = await asyncio.to_thread(hash_upload, uploaded_file)
+                                
+                                # デコードより先にキャッシュを確認し、キャッシュにある場合はデコードしない
+                                # 同じ内容のファイルを文字起こし中だとキャッシュのロックで待たされるため、スレッドで確認する
+                                cached = await asyncio.to_thread(
+                                    lookup_cached_result, audio_hash, model_option, device, compute_type, options
+                                )
+                                if cached is not None:
+                                    return build_file_result(uploaded_file.name, cached, time.time() - lookup_start)
+                                
+                                # デコードは専用スレッドで先行させ、前のファイルの文字起こしと重ねる
+                                audio = decoder.submit(decode_upload, uploaded_file)
+                                
+                                if batch_short_clips:
+                                    decoded = await asyncio.wrap_future(audio)
+                                    if len(decoded) <= SHORT_CLIP_SAMPLES:
+                                        short_clips[idx] = (audio_hash, decoded)
+                                
+                                is_sorted = True
+                                mark_sorted()
+                                
+                                if idx not in short_clips:
+                                    async with slots:
+                                        return await asyncio.to_thread(
+                                            transcribe_file, uploaded_file, audio_hash, audio, model_option, device,
+                                            compute_type, options, segment_callback(idx)
+                                        )
+                            finally:
+                                # 途中で失敗・中断した場合、未着手のデコードは取り消す
+                                if audio is not None:
+                                    audio.cancel()
                         
-                        start_formatted = str(datetime.utcfromtimestamp(start_time).strftime('%H:%M:%S.%f'))[:-3]
-                        end_formatted = str(datetime.utcfromtimestamp(end_time).strftime('%H:%M:%S.%f'))[:-3]
+                        # 短いファイルは先読みの枠を空けてから、全ファイルが出揃うのを待つ
+                        await all_sorted.wait()
+                        if is_batched(idx):
+                            return None
                         
-                        timestamp_text += f"[{start_formatted} --> {end_formatted}] {text}\n"
+                        async with slots:
+                            return await asyncio.to_thread(
+                                transcribe_file, uploaded_file, audio_hash, audio, model_option, device,
+                                compute_type, options, segment_callback(idx)
+                            )
+                    finally:
+                        # キャッシュにヒットした場合や失敗した場合も、振り分け済みとして数える
+                        if not is_sorted:
+                            mark_sorted()
+                
+                async def transcribe_batch(batch):
+                    """短いファイルをまとめて文字起こしし、(インデックス, 結果)のリストを返す"""
+                    async with slots:
+                        try:
+                            batch_results = await asyncio.to_thread(
+                                transcribe_short_files,
+                                [uploaded_files[idx] for idx in batch],
+                                [short_clips[idx][0] for idx in batch],
+                                [short_clips[idx][1] for idx in batch],
+                                model_option, device, compute_type, options,
+                                [segment_callback(idx) for idx in batch]
+                            )
+                        except Exception as e:
+                            batch_results = [e] * len(batch)
+                    
+                    for idx in batch:
+                        on_file_done(idx)
+                    return list(zip(batch, batch_results))
+                
+                async def transcribe_short_clips():
+                    """短いファイルが出揃った時点で、長いファイルの文字起こしと並行してバッチサイズごとに処理する"""
+                    await all_sorted.wait()
+                    short_indices = [idx for idx in sorted(short_clips) if is_batched(idx)]
+                    batches = await asyncio.gather(*(
+                        transcribe_batch(short_indices[start:start + options["batch_size"]])
+                        for start in range(0, len(short_indices), options["batch_size"])
+                    ))
+                    return [item for batch in batches for item in batch]
+                
+                def on_task_done(idx):
+                    # まとめて処理する短いファイルは、バッチの完了時点で完了とする
+                    if not is_batched(idx):
+                        on_file_done(idx)
+                
+                short_task = asyncio.create_task(transcribe_short_clips())
+                with ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-decoder") as decoder:
+                    tasks = []
+                    for idx, uploaded_file in enumerate(uploaded_files):
+                        task = asyncio.create_task(transcribe_one(decoder, idx, uploaded_file))
+                        task.add_done_callback(lambda _, idx=idx: on_task_done(idx))
+                        tasks.append(task)
                     
-                    all_timestamps.append({
-                        "filename": file_name,
-                        "timestamp_text": timestamp_text
-                    })
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                
+                for idx, result in await short_task:
+                    results[idx] = result
                 
-                except Exception as e:
-                    st.error(f"エラーが発生しました ({file_name}): {str(e)}")
+                return results
+            
+            # 各ファイルをワーカースレッドで並列に処理
+            status_text.text(f"処理中: 0/{len(uploaded_files)}")
+            results = asyncio.run(transcribe_all())
+            
+            # プレビューを消して最終結果の表示に切り替える
+            preview_area.empty()
+            
+            for uploaded_file, result in zip(uploaded_files, results):
+                if isinstance(result, Exception):
+                    st.error(f"エラーが発生しました ({uploaded_file.name}): {str(result)}")
+                    continue
                 
-                finally:
-                    # 一時ファイルの削除
-                    if os.path.exists(temp_filename):
-                        os.unlink(temp_filename)
+                file_result, timestamp_text = result
+                all_results.append(file_result)
+                all_timestamps[file_result["filename"]] = timestamp_text
             
             # 進捗完了
             progress_bar.progress(1.0)
             status_text.text("処理完了！")
             
-            # 結果の表示
-            st.markdown("### 文字起こし結果")
-            
-            # タブで各ファイルの結果を表示
-            tabs = st.tabs([f"📄 {result['filename']}" for result in all_results])
-            
-            for tab, result in zip(tabs, all_results):
-                with tab:
-                    st.success(f"処理時間: {result['transcribe_time']:.2f}秒")
-                    
-                    # 音声再生
-                    for uploaded_file in uploaded_files:
-                        if uploaded_file.name == result["filename"]:
+            # 結果の表示（全ファイルが失敗した場合は表示するタブがない）
+            if all_results:
+                st.markdown("### 文字起こし結果")
+                
+                # タブで各ファイルの結果を表示
+                files_by_name = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files}
+                tabs = st.tabs([f"📄 {result['filename']}" for result in all_results])
+                
+                for tab, result in zip(tabs, all_results):
+                    with tab:
+                        st.success(f"処理時間: {result['transcribe_time']:.2f}秒")
+                        
+                        # 音声再生
+                        uploaded_file = files_by_name.get(result["filename"])
+                        if uploaded_file is not None:
                             st.audio(uploaded_file, format=f"audio/{uploaded_file.name.split('.')[-1]}")
-                            break
-                    
-                    # テキスト結果表示
-                    st.text_area(f"{result['filename']} のテキスト", value=result["text"], height=200, key=f"text_{result['filename']}")
-                    
-                    # 個別ダウンロードボタン
-                    st.download_button(
-                        label=f"{result['filename']} をダウンロード",
-                        data=result["text"],
-                        file_name=f"{os.path.splitext(result['filename'])[0]}_transcript.txt",
-                        mime="text/plain",
-                        key=f"download_{result['filename']}"
-                    )
-                    
-                    # タイムスタンプ付きの詳細結果
-                    with st.expander("詳細（タイムスタンプ付き）"):
-                        # タイムスタンプ付きテキストを検索
-                        timestamp_data = next((t for t in all_timestamps if t["filename"] == result["filename"]), None)
-                        if timestamp_data:
-                            st.text_area("タイムスタンプ付きテキスト", 
-                                       value=timestamp_data["timestamp_text"], 
-                                       height=200, 
-                                       key=f"timestamp_{result['filename']}")
-                            
-                            st.download_button(
-                                label="タイムスタンプ付きテキストをダウンロード",
-                                data=timestamp_data["timestamp_text"],
-                                file_name=f"{os.path.splitext(result['filename'])[0]}_transcript_timestamps.txt",
-                                mime="text/plain",
-                                key=f"download_timestamp_{result['filename']}"
-                            )
+                        
+                        # テキスト結果表示
+                        st.text_area(f"{result['filename']} のテキスト", value=result["text"], height=200, key=f"text_{result['filename']}")
+                        
+                        # 個別ダウンロードボタン
+                        st.download_button(
+                            label=f"{result['filename']} をダウンロード",
+                            data=result["text"],
+                            file_name=f"{os.path.splitext(result['filename'])[0]}_transcript.txt",
+                            mime="text/plain",
+                            key=f"download_{result['filename']}"
+                        )
+                        
+                        # タイムスタンプ付きの詳細結果
+                        with st.expander("詳細（タイムスタンプ付き）"):
+                            # タイムスタンプ付きテキストを検索
+                            timestamp_text = all_timestamps.get(result["filename"])
+                            if timestamp_text is not None:
+                                st.text_area("タイムスタンプ付きテキスト", 
+                                           value=timestamp_text, 
+                                           height=200, 
+                                           key=f"timestamp_{result['filename']}")
+                                
+                                st.download_button(
+                                    label="タイムスタンプ付きテキストをダウンロード",
+                                    data=timestamp_text,
+                                    file_name=f"{os.path.splitext(result['filename'])[0]}_transcript_timestamps.txt",
+                                    mime="text/plain",
+                                    key=f"download_timestamp_{result['filename']}"
+                                )
             
             # 全ファイルまとめてダウンロード（ZIPファイル形式）
             if len(all_results) > 1:
@@ -277,9 +807,9 @@ def main():
                 with zipfile.ZipFile(timestamp_zip_buffer, 'w', zipfile.ZIP_DEFLATED) as timestamp_zipf:
                     for result in all_results:
                         filename = os.path.splitext(result['filename'])[0]
-                        timestamp_data = next((t for t in all_timestamps if t["filename"] == result["filename"]), None)
-                        if timestamp_data:
-                            timestamp_zipf.writestr(f"{filename}_transcript_timestamps.txt", timestamp_data["timestamp_text"])
+                        timestamp_text = all_timestamps.get(result["filename"])
+                        if timestamp_text is not None:
+                            timestamp_zipf.writestr(f"{filename}_transcript_timestamps.txt", timestamp_text)
                 
                 # バッファの位置を先頭に戻す
                 text_zip_buffer.seek(0)
@@ -305,18 +835,19 @@ def main():
                 
                 # 元の単一ファイルダウンロードオプションも残す
                 with st.expander("単一ファイルとしてまとめてダウンロード"):
-                    # 全テキストを結合
-                    combined_text = ""
-                    combined_timestamp_text = ""
+                    # 全テキストを結合（リストに集めてから一度だけ連結する）
+                    text_parts = []
+                    timestamp_parts = []
                     
                     for result in all_results:
-                        combined_text += f"=== {result['filename']} ===\n\n"
-                        combined_text += result["text"] + "\n\n"
+                        text_parts.append(f"=== {result['filename']} ===\n\n{result['text']}\n\n")
                         
-                        timestamp_data = next((t for t in all_timestamps if t["filename"] == result["filename"]), None)
-                        if timestamp_data:
-                            combined_timestamp_text += f"=== {result['filename']} ===\n\n"
-                            combined_timestamp_text += timestamp_data["timestamp_text"] + "\n\n"
+                        timestamp_text = all_timestamps.get(result["filename"])
+                        if timestamp_text is not None:
+                            timestamp_parts.append(f"=== {result['filename']} ===\n\n{timestamp_text}\n\n")
+                    
+                    combined_text = "".join(text_parts)
+                    combined_timestamp_text = "".join(timestamp_parts)
                     
                     col3, col4 = st.columns(2)
                     
@@ -358,7 +889,7 @@ def main():
             
             **複数ファイルの処理について:**
             - 同時に複数のファイルを選択できます
-            - 各ファイルは順番に処理されます
+            - 複数のファイルは並列に処理されます
             - 結果はタブで切り替えて確認できます
             - 複数のファイルを個別のテキストファイルとしてZIPでまとめてダウンロードできます
             - 必要に応じて、すべての結果を単一のテキストファイルとしてもダウンロード可能です
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+"""
+文字起こし結果のタイムスタンプ整形（app.pyとtranscribe.pyで共通）
+"""
+
+def format_timestamp(seconds):
+    """秒数を HH:MM:SS.mmm 形式の文字列に変換する"""
+    # 切り捨てると浮動小数点の誤差で1ミリ秒ずれるため、四捨五入する
+    ms = round(seconds * 1000)
+    return f"{ms // 3600000:02d}:{(ms // 60000) % 60:02d}:{(ms // 1000) % 60:02d}.{ms % 1000:03d}"
+
+def format_segment(segment):
+    """セグメント（start, end, textを持つdict）をタイムスタンプ付きの1行に整形する"""
+    return f"[{format_timestamp(segment['start'])} --> {format_timestamp(segment['end'])}] {segment['text']}\n"
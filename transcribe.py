@@ -4,12 +4,18 @@ Whisperを使用した音声文字起こしスクリプト
 """
 
 import os
+
+# 推論のスレッド数（1コアは他の処理用に残す）。torchのimportより前に設定する必要がある
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) - 1)))
+
 import argparse
+import subprocess
+import numpy as np
 import whisper
 import torch
 import time
 import sys
-from datetime import datetime
+from timestamp_utils import format_segment
 
 def check_ffmpeg():
     """FFmpegがインストールされているか確認"""
@@ -22,7 +28,86 @@ def get_available_models():
     """利用可能なWhisperモデルの一覧を返す"""
     return ["tiny", "base", "small", "medium", "large"]
 
-def transcribe_audio(file_path, model_name="base", language=None):
+def load_audio(file_path, sr=whisper.audio.SAMPLE_RATE):
+    """
+    音声ファイルをモノラルのfloat32配列として読み込む
+    
+    whisper.audio.load_audioと同じ変換を行うが、FFmpegのストリーム解析を最小限にして起動を速くする
+    
+    Parameters:
+        file_path (str): 音声ファイルのパス
+        sr (int): リサンプリング後のサンプリングレート
+        
+    Returns:
+        numpy.ndarray: 音声波形（-1.0〜1.0）
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads", "0",
+        "-probesize", "32",
+        "-analyzeduration", "0",
+        "-i", file_path,
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(sr),
+        "-"
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"音声の読み込みに失敗しました: {e.stderr.decode()}") from e
+    
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+def load_model(model_name, device, compile_model=False):
+    """
+    Whisperモデルをロードする
+    
+    CPUではLinear層を動的int8量子化する
+    GPUでは重みをfp32のまま保持する（fp16推論時はwhisperのLinear/Conv1dが入力のdtypeに合わせて重みを変換する）
+    
+    Parameters:
+        model_name (str): Whisperモデルの名前
+        device (str): 使用するデバイス ("cpu" または "cuda")
+        compile_model (bool): GPU使用時にエンコーダをtorch.compileでコンパイルするか
+        
+    Returns:
+        whisper.model.Whisper: ロードしたモデル
+    """
+    if device == "cpu":
+        # 演算内の並列度をOMP_NUM_THREADSに合わせ、演算間の並列化は行わない
+        torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+        
+        # set_num_interop_threadsはプロセス内で一度しか呼べないため、
+        # 2回目以降のtranscribe_audio呼び出しや並列処理の開始後は設定を諦める
+        if torch.get_num_interop_threads() != 1:
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass
+    
+    model = whisper.load_model(model_name, device=device)
+    
+    if device == "cpu":
+        # whisperのLinearはnn.Linearのサブクラスのため、そのままでは量子化の対象にならない
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        # 入力形状は固定なので、cuDNNに最速の畳み込みアルゴリズムを選ばせる
+        torch.backends.cudnn.benchmark = True
+        
+        if compile_model:
+            # エンコーダの入力は常に30秒分の固定長なので、CUDA Graphで再利用できる
+            # （デコーダはKVキャッシュの長さが毎ステップ変わるため対象外）
+            model.encoder = torch.compile(model.encoder, mode="reduce-overhead")
+    
+    return model
+
+def transcribe_audio(file_path, model_name="base", language=None, compile_model=False):
     """
     音声ファイルを文字起こしする
     
@@ -30,6 +115,7 @@ def transcribe_audio(file_path, model_name="base", language=None):
         file_path (str): 音声ファイルのパス
         model_name (str): Whisperモデルの名前 (tiny, base, small, medium, large)
         language (str): 音声の言語コード (例: "ja" for 日本語)
+        compile_model (bool): GPU使用時にtorch.compileを使用するか
         
     Returns:
         dict: 文字起こし結果
@@ -51,13 +137,13 @@ def transcribe_audio(file_path, model_name="base", language=None):
     print(f"デバイス: {device}")
     
     # モデルをロード
-    model = whisper.load_model(model_name, device=device)
+    model = load_model(model_name, device, compile_model)
     
     load_time = time.time() - start_time
     print(f"モデルのロード完了（{load_time:.2f}秒）")
     
-    # 文字起こしのオプション
-    options = {}
+    # 文字起こしのオプション（GPUではfp16で推論）
+    options = {"fp16": device == "cuda"}
     if language:
         options["language"] = language
     
@@ -65,7 +151,8 @@ def transcribe_audio(file_path, model_name="base", language=None):
     print(f"文字起こし中: {file_path}")
     transcribe_start = time.time()
     
-    result = model.transcribe(file_path, **options)
+    audio = load_audio(file_path)
+    result = model.transcribe(audio, **options)
     
     transcribe_time = time.time() - transcribe_start
     print(f"文字起こし完了（{transcribe_time:.2f}秒）")
@@ -99,6 +186,8 @@ def main():
                         help="使用するWhisperモデル (デフォルト: base)")
     parser.add_argument("--language", help="音声の言語コード (例: ja, en)")
     parser.add_argument("--output", help="出力ファイルのパス (指定しない場合は標準出力)")
+    parser.add_argument("--compile", action="store_true",
+                        help="GPU使用時にtorch.compileでエンコーダを高速化する (長い音声向け)")
     
     args = parser.parse_args()
     
@@ -107,7 +196,7 @@ def main():
     
     try:
         # 文字起こし実行
-        result = transcribe_audio(args.file, args.model, args.language)
+        result = transcribe_audio(args.file, args.model, args.language, args.compile)
         
         # 結果を保存または表示
         save_result(result, args.output)
@@ -117,16 +206,7 @@ def main():
             timestamp_output = args.output.replace('.txt', '_timestamps.txt')
             
             with open(timestamp_output, 'w', encoding='utf-8') as f:
-                for segment in result["segments"]:
-                    start_time = segment["start"]
-                    end_time = segment["end"]
-                    text = segment["text"]
-                    
-                    # 時間をフォーマット (HH:MM:SS.ms)
-                    start_formatted = str(datetime.utcfromtimestamp(start_time).strftime('%H:%M:%S.%f'))[:-3]
-                    end_formatted = str(datetime.utcfromtimestamp(end_time).strftime('%H:%M:%S.%f'))[:-3]
-                    
-                    f.write(f"[{start_formatted} --> {end_formatted}] {text}\n")
+                f.write("".join(format_segment(segment) for segment in result["segments"]))
             
             print(f"タイムスタンプ付き結果を保存しました: {timestamp_output}")
         